@@ -11,18 +11,23 @@ from __future__ import print_function
 
 import sys
 import argparse
+import threading
 import rospy
 import mavros
 
-from tf.transformations import quaternion_from_euler
+from math import sin, cos
 from sensor_msgs.msg import Joy
-from std_msgs.msg import Header, Float64
-from geometry_msgs.msg import PoseStamped, TwistStamped, Vector3, Quaternion, Point
+from std_msgs.msg import Float64
+from geometry_msgs.msg import PoseStamped, TwistStamped
 from mavros_msgs.msg import OverrideRCIn
 from mavros import command
 from mavros import setpoint as SP
 
 
+# cached variant sends updates only on change, stock get_param on older distros
+get_param_cached = getattr(rospy, 'get_param_cached', rospy.get_param)
+
+
 def arduino_map(x, inmin, inmax, outmin, outmax):
     return (x - inmin) * (outmax - outmin) / (inmax - inmin) + outmin
 
@@ -34,15 +39,32 @@ class RCChan(object):
         self.min = 1000
         self.max = 2000
         self.min_pos = min_pos
+        self._update_coeffs()
+
+    def _update_coeffs(self):
+        # constants of the min_pos..1.0 -> min..max affine map,
+        # so calc_us does one mul + add instead of full arduino_map
+        self._scale = (self.max - self.min) / (1.0 - self.min_pos)
+        self._offset = self.min - self.min_pos * self._scale
 
-    def load_param(self):
-        self.chan = rospy.get_param("~rc_map/" + self.name, self.chan)
-        self.min = rospy.get_param("~rc_min/" + self.name, self.min)
-        self.max = rospy.get_param("~rc_max/" + self.name, self.max)
+    def load_param(self, ns):
+        self.chan = ns.get('rc_map', {}).get(self.name, self.chan)
+        self.min = ns.get('rc_min', {}).get(self.name, self.min)
+        self.max = ns.get('rc_max', {}).get(self.name, self.max)
+        self._update_coeffs()
 
     def calc_us(self, pos):
         # warn: limit check
-        return arduino_map(pos, self.min_pos, 1.0, self.min, self.max)
+        return int(pos * self._scale + self._offset)
+
+
+def pack_buttons(buttons):
+    # pack the buttons array into an int bitset, done once per callback
+    bits = 0
+    for i, b in enumerate(buttons):
+        bits |= (b & 1) << i
+    return bits
+
 
 class RCMode(object):
     def __init__( self, name, joy_flags, rc_channel, rc_value ):
@@ -50,22 +72,59 @@ class RCMode(object):
         self.joy_flags = joy_flags
         self.rc_channel = rc_channel
         self.rc_value = rc_value
-        
+        # required button pattern folded into two ints: one bitset compare
+        # per sample instead of a Python loop over (btn, flag) pairs.
+        # OR, not sum: a button duplicated in the YAML must not carry
+        # into neighbouring bits
+        self._mask = 0
+        self._pattern = 0
+        for b, f in joy_flags:
+            self._mask |= 1 << b
+            self._pattern |= (f & 1) << b
+
     @staticmethod
-    def load_param(ns='~rc_modes/'):
-        yaml = rospy.get_param(ns)
-        return [ RCMode( name, data['joy_flags'], data['rc_channel'], data['rc_value'] ) 
+    def load_param(yaml):
+        return [ RCMode( name, data['joy_flags'], data['rc_channel'], data['rc_value'] )
             for name,data in yaml.items() ]
-        
-    def is_toggled(self,joy):
-        for btn,flag in self.joy_flags:
-            if joy.buttons[btn] != flag:
-                return False
-        return True
-        
-    def apply_mode(self,joy,rc):
-        if self.is_toggled(joy):
-            rc.channels[self.rc_channel]=self.rc_value
+
+
+class LatestOnlyDispatcher(object):
+    """Run a subscriber callback on its own thread, always with the newest message.
+
+    rospy executes callbacks inside the receive loop, so a callback slower than
+    the publish period makes messages pile up despite queue_size=1. Reception
+    only swaps the latest message into a one-slot buffer; the worker thread
+    picks it up and runs the real callback.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._latest = None
+        thd = threading.Thread(target=self._worker)
+        thd.daemon = True
+        thd.start()
+
+    def on_msg(self, msg):
+        with self._lock:
+            self._latest = msg
+        self._event.set()
+
+    def _worker(self):
+        while True:
+            self._event.wait()
+            with self._lock:
+                msg = self._latest
+                self._latest = None
+                self._event.clear()
+            if msg is not None:
+                # survive callback errors like rospy's receive loop does
+                try:
+                    self.callback(msg)
+                except Exception as ex:
+                    rospy.logerr("bad callback: %s: %s", self.callback.__name__, ex)
+
 
 # Mode 2 on Logitech F710 gamepad
 axes_map = {
@@ -111,13 +170,19 @@ def arm(args, state):
         rospy.loginfo("Request success.")
 
 
-def load_map(m, n):
+def load_map(m, subtree):
     for k, v in m.items():
-        m[k] = rospy.get_param(n + k, v)
+        m[k] = subtree.get(k, v)
 
 
-def get_axis(j, n):
-    return j.axes[axes_map[n]] * axes_scale[n]
+def _load_common_params():
+    # one roundtrip for the whole private namespace instead of per-key calls
+    ns = rospy.get_param('~', {})
+    load_map(axes_map, ns.get('axes_map', {}))
+    load_map(axes_scale, ns.get('axes_scale', {}))
+    load_map(button_map, ns.get('button_map', {}))
+    return ns
+
 
 def get_buttons(j, n):
     return j.buttons[ button_map[n]]
@@ -125,72 +190,123 @@ def get_buttons(j, n):
 def rc_override_control(args):
     rospy.loginfo("MAV-Teleop: RC Override control type.")
 
-    load_map(axes_map, '~axes_map/')
-    load_map(axes_scale, '~axes_scale/')
-    load_map(button_map, '~button_map/')
-    for k, v in rc_channels.items():
-        v.load_param()
+    # hoisted so disabled-debug samples skip rospy logging entirely
+    verbose = args.verbose
 
-    rc_modes = RCMode.load_param()
+    ns = _load_common_params()
+    for k, v in rc_channels.items():
+        v.load_param(ns)
+
+    # resolve axis index and scale once; the maps are immutable after load_map
+    roll_i, roll_s = axes_map['roll'], axes_scale['roll']
+    pitch_i, pitch_s = axes_map['pitch'], axes_scale['pitch']
+    yaw_i, yaw_s = axes_map['yaw'], axes_scale['yaw']
+    thr_i, thr_s = axes_map['throttle'], axes_scale['throttle']
+
+    rc_modes = RCMode.load_param(ns.get('rc_modes', {}))
+    # modes flattened to (chan, value, mask, pattern) rows: the overlay
+    # loop needs no attribute lookups or method calls per sample
+    modes_table = tuple((m.rc_channel, m.rc_value, m._mask, m._pattern)
+        for m in rc_modes)
+    # outbound message preallocated once, fields mutated in place
     rc = OverrideRCIn()
 
     override_pub = rospy.Publisher(mavros.get_topic("rc", "override"), OverrideRCIn, queue_size=10)
 
-    def joy_cb(joy):
-        # get axes normalized to -1.0..+1.0 RPY, 0.0..1.0 T
-        roll = get_axis(joy, 'roll')
-        pitch = get_axis(joy, 'pitch')
-        yaw = get_axis(joy, 'yaw')
-        throttle = arduino_map(get_axis(joy, 'throttle'), -1.0, 1.0, 0.0, 1.0)
-
-        rospy.logdebug("RPYT: %f, %f, %f, %f", roll, pitch, yaw, throttle)
-
-        def set_chan(n, v):
-            ch = rc_channels[n]
-            rc.channels[ch.chan] = ch.calc_us(v)
-            rospy.logdebug("RC%d (%s): %d us", ch.chan, ch.name, ch.calc_us(v))
-
-
-        set_chan('roll', roll)
-        set_chan('pitch', pitch)
-        set_chan('yaw', yaw)
-        set_chan('throttle', throttle)
-        
-        for m in rc_modes:
-            m.apply_mode(joy,rc)
-        
-        override_pub.publish(rc)
+    # channel lookups hoisted out of the callback: closure locals
+    # instead of four dict + attribute lookups per sample
+    roll_ch = rc_channels['roll']
+    pitch_ch = rc_channels['pitch']
+    yaw_ch = rc_channels['yaw']
+    thr_ch = rc_channels['throttle']
 
+    # skip republishing unchanged output at idle; the heartbeat keeps
+    # downstream RC timeout watchdogs fed. RC-loss timeouts differ per
+    # FCU stack, so the period is a parameter like the channel maps.
+    last_pub = {'channels': None, 'time': rospy.Time(0)}
+    heartbeat = rospy.Duration(ns.get('override_heartbeat', 0.2))
 
-    jsub = rospy.Subscriber("joy", Joy, joy_cb)
+    def joy_cb(joy):
+        # get axes normalized to -1.0..+1.0 RPY, 0.0..1.0 T
+        roll = joy.axes[roll_i] * roll_s
+        pitch = joy.axes[pitch_i] * pitch_s
+        yaw = joy.axes[yaw_i] * yaw_s
+        throttle = arduino_map(joy.axes[thr_i] * thr_s, -1.0, 1.0, 0.0, 1.0)
+
+        if verbose:
+            rospy.logdebug("RPYT: %f, %f, %f, %f", roll, pitch, yaw, throttle)
+
+        r_us = roll_ch.calc_us(roll)
+        p_us = pitch_ch.calc_us(pitch)
+        y_us = yaw_ch.calc_us(yaw)
+        t_us = thr_ch.calc_us(throttle)
+
+        # batch the channel writes just before publish, so rc_modes
+        # overlay a fully updated base message
+        channels = rc.channels
+        channels[roll_ch.chan] = r_us
+        channels[pitch_ch.chan] = p_us
+        channels[yaw_ch.chan] = y_us
+        channels[thr_ch.chan] = t_us
+
+        if modes_table:
+            bits = pack_buttons(joy.buttons)
+            for chan, val, mask, pattern in modes_table:
+                if (bits & mask) == pattern:
+                    channels[chan] = val
+
+        now = rospy.Time.now()
+        cur = tuple(channels)
+        if cur != last_pub['channels'] or now - last_pub['time'] >= heartbeat:
+            last_pub['channels'] = cur
+            last_pub['time'] = now
+            override_pub.publish(rc)
+
+
+    jdisp = LatestOnlyDispatcher(joy_cb)
+    jsub = rospy.Subscriber("joy", Joy, jdisp.on_msg, queue_size=1, buff_size=65536, tcp_nodelay=True)
     rospy.spin()
 
 
 def attitude_setpoint_control(args):
     rospy.loginfo("MAV-Teleop: Attitude setpoint control type.")
 
-    load_map(axes_map, '~axes_map/')
-    load_map(axes_scale, '~axes_scale/')
-    load_map(button_map, '~button_map/')
+    # hoisted so disabled-debug samples skip rospy logging entirely
+    verbose = args.verbose
+
+    _load_common_params()
+
+    # resolve axis index and scale once; the maps are immutable after load_map
+    roll_i, roll_s = axes_map['roll'], axes_scale['roll']
+    pitch_i, pitch_s = axes_map['pitch'], axes_scale['pitch']
+    yaw_i, yaw_s = axes_map['yaw'], axes_scale['yaw']
+    thr_i, thr_s = axes_map['throttle'], axes_scale['throttle']
 
     att_pub = SP.get_pub_attitude_pose(queue_size=10)
     thd_pub = SP.get_pub_attitude_throttle(queue_size=10)
 
-    if rospy.get_param(mavros.get_topic("setpoint_attitude", "reverse_throttle"), False):
+    # resolve the topic name once at startup, cached accessor for the param
+    reverse_topic = mavros.get_topic("setpoint_attitude", "reverse_throttle")
+    if get_param_cached(reverse_topic, False):
         def thd_normalize(v):
             return v
     else:
         def thd_normalize(v):
             return arduino_map(v, -1.0, 1.0, 0.0, 1.0)
 
+    # outbound message preallocated once, fields mutated in place
+    pose = PoseStamped()
+    q_msg = pose.pose.orientation
+
     def joy_cb(joy):
         # get axes normalized to -1.0..+1.0 RPY, 0.0..1.0 T
-        roll = get_axis(joy, 'roll')
-        pitch = get_axis(joy, 'pitch')
-        yaw = get_axis(joy, 'yaw')
-        throttle = thd_normalize(get_axis(joy, 'throttle'))
+        roll = joy.axes[roll_i] * roll_s
+        pitch = joy.axes[pitch_i] * pitch_s
+        yaw = joy.axes[yaw_i] * yaw_s
+        throttle = thd_normalize(joy.axes[thr_i] * thr_s)
 
-        rospy.logdebug("RPYT: %f, %f, %f, %f", roll, pitch, yaw, throttle)
+        if verbose:
+            rospy.logdebug("RPYT: %f, %f, %f, %f", roll, pitch, yaw, throttle)
 
         if get_buttons(joy,'arm') == 1:
             arm(args, True)
@@ -198,112 +314,173 @@ def attitude_setpoint_control(args):
             arm(args, False)
 
         # TODO: Twist variation
-        pose = PoseStamped(header=Header(stamp=rospy.get_rostime()))
-        q = quaternion_from_euler(roll, pitch, yaw)
-        pose.pose.orientation = Quaternion(*q)
+        pose.header.stamp = rospy.Time.now()
+        # inlined quaternion_from_euler(roll, pitch, yaw) ('sxyz' axes):
+        # 6 trig calls and no tf call overhead
+        hr, hp, hy = roll * 0.5, pitch * 0.5, yaw * 0.5
+        cr, sr = cos(hr), sin(hr)
+        cp, sp = cos(hp), sin(hp)
+        cy, sy = cos(hy), sin(hy)
+        q_msg.x = sr * cp * cy - cr * sp * sy
+        q_msg.y = cr * sp * cy + sr * cp * sy
+        q_msg.z = cr * cp * sy - sr * sp * cy
+        q_msg.w = cr * cp * cy + sr * sp * sy
 
         att_pub.publish(pose)
         thd_pub.publish(data=throttle)
 
 
-    jsub = rospy.Subscriber("joy", Joy, joy_cb)
+    jdisp = LatestOnlyDispatcher(joy_cb)
+    jsub = rospy.Subscriber("joy", Joy, jdisp.on_msg, queue_size=1, buff_size=65536, tcp_nodelay=True)
     rospy.spin()
 
 
 def velocity_setpoint_control(args):
     rospy.loginfo("MAV-Teleop: Velocity setpoint control type.")
 
-    load_map(axes_map, '~axes_map/')
-    load_map(axes_scale, '~axes_scale/')
-    load_map(button_map, '~button_map/')
+    # hoisted so disabled-debug samples skip rospy logging entirely
+    verbose = args.verbose
+
+    _load_common_params()
+
+    # resolve axis index and scale once; the maps are immutable after load_map
+    roll_i, roll_s = axes_map['roll'], axes_scale['roll']
+    pitch_i, pitch_s = axes_map['pitch'], axes_scale['pitch']
+    yaw_i, yaw_s = axes_map['yaw'], axes_scale['yaw']
+    thr_i, thr_s = axes_map['throttle'], axes_scale['throttle']
 
     vel_pub = SP.get_pub_velocity_cmd_vel(queue_size=10)
 
+    # outbound message preallocated once, fields mutated in place
+    twist = TwistStamped()
+    linear = twist.twist.linear
+    angular = twist.twist.angular
+
     def joy_cb(joy):
         # get axes normalized to -1.0..+1.0 RPYT
-        roll = get_axis(joy, 'roll')
-        pitch = get_axis(joy, 'pitch')
-        yaw = get_axis(joy, 'yaw')
-        throttle = get_axis(joy, 'throttle')
+        roll = joy.axes[roll_i] * roll_s
+        pitch = joy.axes[pitch_i] * pitch_s
+        yaw = joy.axes[yaw_i] * yaw_s
+        throttle = joy.axes[thr_i] * thr_s
 
-        rospy.logdebug("RPYT: %f, %f, %f, %f", roll, pitch, yaw, throttle)
+        if verbose:
+            rospy.logdebug("RPYT: %f, %f, %f, %f", roll, pitch, yaw, throttle)
 
         # Based on QGC UAS joystickinput_settargets branch
         # not shure that it really need inegrating, as it done in QGC.
-        twist = TwistStamped(header=Header(stamp=rospy.get_rostime()))
-        twist.twist.linear = Vector3(x=roll, y=pitch, z=throttle)
-        twist.twist.angular = Vector3(z=yaw)
+        twist.header.stamp = rospy.Time.now()
+        linear.x, linear.y, linear.z = roll, pitch, throttle
+        angular.z = yaw
 
         vel_pub.publish(twist)
 
 
-    jsub = rospy.Subscriber("joy", Joy, joy_cb)
+    jdisp = LatestOnlyDispatcher(joy_cb)
+    jsub = rospy.Subscriber("joy", Joy, jdisp.on_msg, queue_size=1, buff_size=65536, tcp_nodelay=True)
     rospy.spin()
 
 
 px, py, pz = 0.0, 0.0, 0.0
 
+# setpoint rate at full stick deflection, units per second
+POS_STICK_RATE = 1.0
+
 def position_setpoint_control(args):
     rospy.loginfo("MAV-Teleop: Position setpoint control type.")
 
-    load_map(axes_map, '~axes_map/')
-    load_map(axes_scale, '~axes_scale/')
-    load_map(button_map, '~button_map/')
+    # hoisted so disabled-debug samples skip rospy logging entirely
+    verbose = args.verbose
+
+    _load_common_params()
+
+    # resolve axis index and scale once; the maps are immutable after load_map
+    roll_i, roll_s = axes_map['roll'], axes_scale['roll']
+    pitch_i, pitch_s = axes_map['pitch'], axes_scale['pitch']
+    yaw_i, yaw_s = axes_map['yaw'], axes_scale['yaw']
+    thr_i, thr_s = axes_map['throttle'], axes_scale['throttle']
 
     pos_pub = SP.get_pub_position_local(queue_size=10)
 
+    # outbound message preallocated once, fields mutated in place
+    pose = PoseStamped()
+    pt_msg = pose.pose.position
+    q_msg = pose.pose.orientation
+
+    # last sample time in a one-element list so joy_cb can update it
+    last_t = [None]
+
     def joy_cb(joy):
         global px, py, pz
         # get axes normalized to -1.0..+1.0 RPY
-        roll = get_axis(joy, 'roll')
-        pitch = get_axis(joy, 'pitch')
-        yaw = get_axis(joy, 'yaw')
-        throttle = get_axis(joy, 'throttle')
-
-        # TODO: need integrate by time, joy_cb() called with variable frequency
-        px -= pitch
-        py += roll
-        pz += throttle
-
-        rospy.logdebug("RPYT: %f, %f, %f, %f", roll, pitch, yaw, throttle)
-        rospy.logdebug("Point(%f %f %f)", px, py, pz)
+        roll = joy.axes[roll_i] * roll_s
+        pitch = joy.axes[pitch_i] * pitch_s
+        yaw = joy.axes[yaw_i] * yaw_s
+        throttle = joy.axes[thr_i] * thr_s
+
+        # integrate by real dt, so jitter in joy cadence does not
+        # change how fast the setpoint moves. Clamp the step so a gap
+        # in joy messages or a clock step backwards (sim reset, looping
+        # rosbag) cannot command a large setpoint jump.
+        stamp = joy.header.stamp
+        now = stamp.to_sec() if stamp else rospy.get_time()
+        dt = 0.0 if last_t[0] is None else min(max(now - last_t[0], 0.0), 0.5)
+        last_t[0] = now
+
+        px -= pitch * dt * POS_STICK_RATE
+        py += roll * dt * POS_STICK_RATE
+        pz += throttle * dt * POS_STICK_RATE
+
+        if verbose:
+            rospy.logdebug("RPYT: %f, %f, %f, %f", roll, pitch, yaw, throttle)
+            rospy.logdebug("Point(%f %f %f)", px, py, pz)
 
         # Based on QGC UAS joystickinput_settargets branch
-        pose = PoseStamped(header=Header(stamp=rospy.get_rostime()))
-        pose.pose.position = Point(x=px, y=py, z=pz)
-        q = quaternion_from_euler(0, 0, yaw)
-        pose.pose.orientation = Quaternion(*q)
+        pose.header.stamp = rospy.Time.now()
+        pt_msg.x, pt_msg.y, pt_msg.z = px, py, pz
+        # yaw-only rotation: closed form, x and y stay zero
+        half_yaw = yaw * 0.5
+        q_msg.z = sin(half_yaw)
+        q_msg.w = cos(half_yaw)
 
         pos_pub.publish(pose)
 
 
-    jsub = rospy.Subscriber("joy", Joy, joy_cb)
+    jdisp = LatestOnlyDispatcher(joy_cb)
+    jsub = rospy.Subscriber("joy", Joy, jdisp.on_msg, queue_size=1, buff_size=65536, tcp_nodelay=True)
     rospy.spin()
 
 
+MODES = {
+    'rc': rc_override_control,
+    'att': attitude_setpoint_control,
+    'vel': velocity_setpoint_control,
+    'pos': position_setpoint_control,
+}
+
+
 def main():
     parser = argparse.ArgumentParser(description="Teleoperation script for Copter-UAV")
     parser.add_argument('-n', '--mavros-ns', help="ROS node namespace", default=mavros.DEFAULT_NAMESPACE)
     parser.add_argument('-v', '--verbose', action='store_true', help="verbose output")
     mode_group = parser.add_mutually_exclusive_group(required=True)
-    mode_group.add_argument('-rc', '--rc-override', action='store_true', help="use rc override control type")
-    mode_group.add_argument('-att', '--sp-attitude', action='store_true', help="use attitude setpoint control type")
-    mode_group.add_argument('-vel', '--sp-velocity', action='store_true', help="use velocity setpoint control type")
-    mode_group.add_argument('-pos', '--sp-position', action='store_true', help="use position setpoint control type")
+    mode_group.add_argument('-m', '--mode', choices=('rc', 'att', 'vel', 'pos'), help="control type")
+    # aliases for the old per-mode flags
+    mode_group.add_argument('-rc', '--rc-override', dest='mode', action='store_const', const='rc', help="same as --mode rc")
+    mode_group.add_argument('-att', '--sp-attitude', dest='mode', action='store_const', const='att', help="same as --mode att")
+    mode_group.add_argument('-vel', '--sp-velocity', dest='mode', action='store_const', const='vel', help="same as --mode vel")
+    mode_group.add_argument('-pos', '--sp-position', dest='mode', action='store_const', const='pos', help="same as --mode pos")
 
     args = parser.parse_args(rospy.myargv(argv=sys.argv)[1:])
 
     rospy.init_node("mavteleop")
     mavros.set_namespace(args.mavros_ns)
 
-    if args.rc_override:
-        rc_override_control(args)
-    elif args.sp_attitude:
-        attitude_setpoint_control(args)
-    elif args.sp_velocity:
-        velocity_setpoint_control(args)
-    elif args.sp_position:
-        position_setpoint_control(args)
+    if not args.verbose:
+        # short-circuit all debug output, including the rosmaster getParam
+        # some rospy versions issue on every log call
+        rospy.logdebug = lambda *a, **kw: None
+
+    MODES[args.mode](args)
 
 
 if __name__ == '__main__':